@@ -1,5 +1,17 @@
 import java.io.*;
+import java.nio.charset.Charset;
+import java.util.ArrayList;
 import java.util.HashMap;
+import java.util.LinkedHashMap;
+import java.util.LinkedHashSet;
+import java.util.List;
+import java.util.Map;
+import java.util.concurrent.ExecutionException;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.Future;
+import java.util.concurrent.TimeUnit;
+import java.util.regex.Pattern;
 
 /**
  *
@@ -17,7 +29,7 @@ public class AnnotationParser
         this.inputPath = inputPath; 
         this.outputPath = outputPath;
         //creates the dictionary that maps each book to its annotations
-        bookContentMap = new HashMap<String,String>();
+        bookContentMap = new HashMap<String,LinkedHashSet<String>>();
         //sets merge to false (see fields below for explanation)
         this.mergeOption = mergeOption;
     }
@@ -52,26 +64,55 @@ public class AnnotationParser
      */
     private void read() throws FileNotFoundException, IOException
     {
-        //creates input reader from the file path
-        BufferedReader input =  new BufferedReader(new FileReader(inputPath));
+        //creates input stream from the file path (throws FileNotFoundException for
+        //missing files and invalid paths alike, as FileReader did)
+        FileInputStream input = new FileInputStream(inputPath);
+        byte[] bytes;
         try
         {
-            String line; 
-            //reads the title into line and maps the book title to its annotations
-            while ((line = input.readLine()) != null) 
-            {
-                //removes the first digit, which is invisible and not a part of the title
-                if (!line.isEmpty() && !Character.isLetterOrDigit(line.charAt(0)))
-                    line = line.substring(1);
-                bookContentMap.merge(line, getAnnotation(input), String::concat);
-                System.out.println(line + " " + line.hashCode());
-            } 
+            //reads the whole file with a single bulk read, instead of in small buffered chunks
+            bytes = new byte[(int) input.getChannel().size()];
+            new DataInputStream(input).readFully(bytes);
         }
         finally
         {
-            //whatever happens, close the input reader
+            //whatever happens, close the input stream
             input.close();
         }
+        //decodes the file in one pass, with the same default charset FileReader would use
+        String content = new String(bytes, Charset.defaultCharset());
+        
+        //splits the file into lines, accepting the same line terminators as readLine()
+        //and keeping empty lines at the end of the file, as readLine() does
+        String[] lines = LINE_BREAK.split(content, -1);
+        //like readLine(), a final line terminator does not start another line
+        lineCount = lines[lines.length - 1].isEmpty() ? lines.length - 1 : lines.length;
+        lineIndex = 0;
+        //reads the title into line and maps the book title to its annotations
+        while (lineIndex < lineCount) 
+        {
+            String line = lines[lineIndex++];
+            //removes the leading invisible characters, such as the byte order mark, which
+            //are not a part of the title (visible punctuation is kept, as it may be)
+            int titleStart = 0;
+            while (titleStart < line.length() && isInvisible(line.charAt(titleStart)))
+                titleStart++;
+            line = line.substring(titleStart);
+            //adds the annotation to the book's set in a single lookup, ignoring exact duplicates
+            bookContentMap.computeIfAbsent(line, book -> new LinkedHashSet<String>()).add(getAnnotation(lines));
+            System.out.println(line + " " + line.hashCode());
+        } 
+    }
+    
+    /**
+     * Returns whether the character is invisible in a title line: the byte order 
+     * mark and other formatting characters, or whitespace.
+     * @param c the character to be checked
+     * @return true if the character is invisible
+     */
+    private static boolean isInvisible(char c)
+    {
+        return c == '\uFEFF' || Character.getType(c) == Character.FORMAT || Character.isWhitespace(c);
     }
     
     /**
@@ -86,58 +127,159 @@ public class AnnotationParser
         File outputFolder = new File(outputPath);
         outputFolder.mkdir();
         
-        //for each book in the bookContentMap, write a separate file with its annotations
-        for (String currentBook : bookContentMap.keySet())
+        //the output files are independent of each other, so they are written in parallel
+        ExecutorService pool = Executors.newFixedThreadPool(
+                Math.min(MAX_WRITER_THREADS, Runtime.getRuntime().availableProcessors() * 4));
+        boolean allWritten = false;
+        try
+        {
+            //groups the books by output file: different title lines may still get the same
+            //file name, and those books must be written by a single thread, one after the
+            //other, so that their writes are not interleaved into one corrupted file
+            //(iterates over the entries, so that the annotations need no second map lookup)
+            Map<String,List<Map.Entry<String,LinkedHashSet<String>>>> booksByOutputName = 
+                    new LinkedHashMap<String,List<Map.Entry<String,LinkedHashSet<String>>>>();
+            for (Map.Entry<String,LinkedHashSet<String>> bookEntry : bookContentMap.entrySet())
+                booksByOutputName.computeIfAbsent(getOutputName(bookEntry.getKey()), 
+                        outputName -> new ArrayList<Map.Entry<String,LinkedHashSet<String>>>()).add(bookEntry);
+            
+            List<Future<Void>> results = new ArrayList<Future<Void>>();
+            //for each output file, write the annotations of its books
+            for (Map.Entry<String,List<Map.Entry<String,LinkedHashSet<String>>>> fileEntry : booksByOutputName.entrySet())
+                results.add(pool.submit(() -> 
+                {
+                    for (Map.Entry<String,LinkedHashSet<String>> bookEntry : fileEntry.getValue())
+                        writeBook(fileEntry.getKey(), bookEntry.getKey(), bookEntry.getValue());
+                    return null;
+                }));
+            //waits until every book has been written, rethrowing the first error found
+            for (Future<Void> result : results)
+                result.get();
+            allWritten = true;
+        }
+        catch (ExecutionException e)
+        {
+            if (e.getCause() instanceof IOException)
+                throw (IOException) e.getCause();
+            if (e.getCause() instanceof RuntimeException)
+                throw (RuntimeException) e.getCause();
+            if (e.getCause() instanceof Error)
+                throw (Error) e.getCause();
+            throw new IOException(e.getCause());
+        }
+        catch (InterruptedException e)
+        {
+            Thread.currentThread().interrupt();
+            throw new InterruptedIOException("Interrupted while writing the annotations.");
+        }
+        finally
         {
-            //gets the title and the author of each book
-            String[] titleAuthor = getTitleAuthor(currentBook);
-            //creates a clean title, containing alphanumeric and punctuation characters
-            String cleanTitle = titleAuthor[TITLE].replaceAll("[^a-zA-Z0-9._ -]+()", "");
-            //limits title to a maximum length fo 128 characters 
-            //(112 from title + 16 from other chars), to avoid errrors
-            cleanTitle = cleanTitle.substring(0, Math.min(cleanTitle.length(), MAX_TITLE_LENGTH));
-            //creates full path to output file, adds hash code to avoid duplicates
-            String outputName = outputPath + cleanTitle + "_" + currentBook.hashCode() + ".txt";
+            if (allWritten)
+                //releases the writer threads
+                pool.shutdown();
+            else
+                //on failure, drops the books not yet written, like the serial loop did
+                stopWriters(pool);
+        }
+    }
+    
+    /**
+     * Stops the writer threads after a failure: the books not yet started are 
+     * dropped, and the books already being written are waited for, so that no
+     * file is still written to once write() has thrown.
+     * @param pool the thread pool writing the book files
+     */
+    private void stopWriters(ExecutorService pool)
+    {
+        pool.shutdownNow();
+        try
+        {
+            pool.awaitTermination(Long.MAX_VALUE, TimeUnit.DAYS);
+        }
+        catch (InterruptedException e)
+        {
+            Thread.currentThread().interrupt();
+        }
+    }
+    
+    /**
+     * Returns the complete path of the output file of a book.
+     * @param currentBook the book's title line, as found in the input file
+     * @return the complete path of the book's output file
+     */
+    private String getOutputName(String currentBook)
+    {
+        //creates a clean title, containing alphanumeric and punctuation characters
+        String cleanTitle = cleanTitle(getTitleAuthor(currentBook)[TITLE]);
+        //creates full path to output file, adds hash code to avoid duplicates
+        //(String.hashCode() is fixed by the Java spec, so the same book always gets
+        //the same file name across runs, which is what merging relies on)
+        return outputPath + cleanTitle + "_" + currentBook.hashCode() + ".txt";
+    }
+    
+    /**
+     * Writes the annotations of one book into its TXT file.
+     * @param outputName the complete path of the book's output file
+     * @param currentBook the book's title line, as found in the input file
+     * @param annotations the book's annotations, in reading order
+     * @throws IOException 
+     */
+    private void writeBook(String outputName, String currentBook, LinkedHashSet<String> annotations) 
+            throws IOException
+    {
+        //gets the title and the author of the book
+        String[] titleAuthor = getTitleAuthor(currentBook);
 
-          
-            //creates output writer
-            BufferedWriter output = new BufferedWriter(new FileWriter(outputName, mergeOption));
-            try
-            {
-                //writes the output content to the file. first "author, title", then annotations
-                output.write(titleAuthor[TITLE] + ", " + titleAuthor[AUTHOR] + NEW_LINE);
-                output.write(NEW_LINE);
-                output.write(bookContentMap.get(currentBook) + NEW_LINE);
-                output.write(NEW_LINE);
-            }
-            finally
-            {
-                //whatever happens, close the output writer
-                output.close();
-            }
+        //creates output writer
+        BufferedWriter output = new BufferedWriter(new FileWriter(outputName, mergeOption));
+        try
+        {
+            //writes the output content to the file. first "author, title", then annotations
+            //(each piece is written on its own, so no concatenated string is created)
+            output.write(titleAuthor[TITLE]);
+            output.write(", ");
+            output.write(titleAuthor[AUTHOR]);
+            output.write(NEW_LINE);
+            output.write(NEW_LINE);
+            //the annotations are written one by one, letting the buffered writer
+            //coalesce them, instead of first joining them into one large string
+            for (String annotation : annotations)
+                output.write(annotation);
+            output.write(NEW_LINE);
+            output.write(NEW_LINE);
+        }
+        finally
+        {
+            //whatever happens, close the output writer
+            output.close();
         }
     }
     
     /**
-     * Reads one annotation entry and returns it. Expects the reader to be 
-     * positioned right after the line with the title of the book.
-     * @param input the input reader for the annotations file
+     * Reads one annotation entry and returns it. Expects lineIndex to be 
+     * positioned right after the line with the title of the book, and leaves 
+     * it right after the annotation break marker.
+     * @param lines the lines of the annotations file
      * @return a string containing the annotation
-     * @throws IOException 
      */
-    private String getAnnotation(BufferedReader input) throws IOException
+    private String getAnnotation(String[] lines)
     {
-        String annotation = "";
-        String currentLine; 
+        //builds the annotation in place, instead of creating a new string for each line
+        StringBuilder annotation = new StringBuilder();
         //while the end of the file is not reached 
-        //and the current line is not equal to the annotation break marker
-        while((currentLine = input.readLine()) != null && !currentLine.equals("=========="))
-            if (currentLine.isEmpty()) //if line is empty
-                annotation += currentLine; //do not print new lines for empty lines
-            else
-                annotation += currentLine + NEW_LINE; //add current line to annotation + new line
+        while (lineIndex < lineCount)
+        {
+            String currentLine = lines[lineIndex++];
+            //stops once the current line is equal to the annotation break marker
+            //(equals() rejects lines of a different length before comparing any characters)
+            if (currentLine.equals(ANNOTATION_BREAK))
+                break;
+            //do not print new lines for empty lines
+            if (!currentLine.isEmpty())
+                annotation.append(currentLine).append(NEW_LINE); //add current line to annotation + new line
+        }
         //return annotation
-        return annotation + NEW_LINE;
+        return annotation.append(NEW_LINE).toString();
     }
     
     /**
@@ -171,23 +313,77 @@ public class AnnotationParser
         return new String[] {title, author};
     }
     
+    /**
+     * Returns the title with only the characters allowed in file names 
+     * (letters, digits and "._ -"), limited to a maximum length of 128 
+     * characters (112 from title + 16 from other chars), to avoid errors.
+     * @param title the title of the book
+     * @return the cleaned up title
+     */
+    private String cleanTitle(String title)
+    {
+        StringBuilder cleanTitle = new StringBuilder(Math.min(title.length(), MAX_TITLE_LENGTH));
+        //keeps the valid characters, checking each one against the lookup table,
+        //and stops as soon as the maximum length is reached
+        for (int i = 0; i < title.length() && cleanTitle.length() < MAX_TITLE_LENGTH; i++)
+        {
+            char currentChar = title.charAt(i);
+            if (currentChar < VALID_TITLE_CHARS.length && VALID_TITLE_CHARS[currentChar])
+                cleanTitle.append(currentChar);
+        }
+        return cleanTitle.toString();
+    }
+    
+    /**
+     * Creates the lookup table used by cleanTitle(), marking the ASCII 
+     * characters that are allowed in file names.
+     * @return a table indexed by character, true for the allowed characters
+     */
+    private static boolean[] createValidTitleCharTable()
+    {
+        boolean[] table = new boolean[128];
+        for (char c = 'a'; c <= 'z'; c++)
+            table[c] = true;
+        for (char c = 'A'; c <= 'Z'; c++)
+            table[c] = true;
+        for (char c = '0'; c <= '9'; c++)
+            table[c] = true;
+        for (char c : "._ -".toCharArray())
+            table[c] = true;
+        return table;
+    }
+    
     //the input file's complete path
     private String inputPath;
     //the output directory's complete path
     private String outputPath;
-    //a map that maps each book to its annotations
-    private HashMap<String,String> bookContentMap;
+    //a map that maps each book to its annotations, kept in reading order
+    //(the annotations themselves are the keys: String caches its hash code, so each
+    //annotation is hashed only once, and there is no risk of colliding hashes)
+    private HashMap<String,LinkedHashSet<String>> bookContentMap;
     //a switch for controling the option of how to handle files that already exist
     //if true, merges annotations to the end of the existing file. if false, replaces
     //file with a new one, only with the current annotations
     private boolean mergeOption;
+    //the index of the next line to be read from the input file's lines
+    private int lineIndex;
+    //the number of lines in the input file, as readLine() would count them
+    private int lineCount;
     
     //variable that stores the system's line separator (new line) character
     private static final String NEW_LINE = System.lineSeparator();
     //the name of the standard output folder
     private static final String STANDARD_OUTPUT_FOLDER = "output";
+    //the line that separates one annotation from the next in Kindle's file
+    private static final String ANNOTATION_BREAK = "==========";
     //max title length, to avoid errors due to too long filenames
     private static final int MAX_TITLE_LENGTH = 112;
+    //matches the same line terminators as readLine(), compiled only once
+    private static final Pattern LINE_BREAK = Pattern.compile("\r\n|\r|\n");
+    //a lookup table of the ASCII characters allowed in output file names
+    private static final boolean[] VALID_TITLE_CHARS = createValidTitleCharTable();
+    //the maximum number of threads used to write the output files
+    private static final int MAX_WRITER_THREADS = 32;
     //the indexes of the title and author elements in the string[] generated by getTitleAuthor()
     private static final int TITLE = 0;
     private static final int AUTHOR = 1;